@@ -1,28 +1,133 @@
+import hashlib
 import json
 import os
+import re
+import threading
+import time
+from concurrent.futures import Future
+import numpy as np
+import orjson
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import date, datetime, timedelta
 from flask import Flask, jsonify, send_file, request
 
 app = Flask(__name__)
 DATA_FILE = 'data_warehouse.json'
+_DATE_RE = re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2})')
 
 # API pública para obtener cotización USD
 
 CURRENCY_API_URL = "https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@{date}/v1/currencies/usd.json"
 
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"prices": {}, "recipes": []}
+# Sesión compartida: reutiliza la conexión TLS (keep-alive) entre consultas.
+# El pool iguala a --threads de gunicorn (ver Dockerfile) para no descartar conexiones.
+HTTP_POOL_SIZE = 8
+# (connect, read): sólo se reintenta la conexión; la lectura se intenta una vez
+CURRENCY_API_TIMEOUT = (3, 5)
 
-def get_usd_rate(date_str):
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=1, pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(total=1, connect=1, read=0, status=0, other=0, backoff_factor=0.2)
+))
+
+# Cache de cotizaciones: {fecha: [cotizacion, timestamp]}
+# Las fechas pasadas no cambian; la del día se refresca cada FX_TODAY_TTL segundos.
+FX_CACHE_FILE = 'fx_cache.json'
+FX_TODAY_TTL = 6 * 60 * 60
+
+def _load_fx_cache():
+    if os.path.exists(FX_CACHE_FILE):
+        try:
+            with open(FX_CACHE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError) as e:
+            print(f"Cache de divisas ilegible, se descarta: {e}")
+    return {}
+
+def _save_fx_cache():
+    # Cada worker tiene su propio _FX_CACHE: fusionar con lo que otros ya
+    # guardaron (gana la consulta más reciente) para no pisar sus fechas.
+    # Best effort: dos escrituras simultáneas aún pueden perder una entrada,
+    # que simplemente se vuelve a consultar.
+    for date_str, entry in _load_fx_cache().items():
+        current = _FX_CACHE.get(date_str)
+        if current is None or entry[1] > current[1]:
+            _FX_CACHE[date_str] = entry
+
+    # Archivo temporal por proceso: varios workers pueden escribir a la vez
+    tmp_file = f"{FX_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(_FX_CACHE, f)
+        os.replace(tmp_file, FX_CACHE_FILE)
+    except IOError as e:
+        print(f"No se pudo guardar el cache de divisas: {e}")
+
+_FX_CACHE = _load_fx_cache()
+_FX_LOCK = threading.Lock()
+# Consultas en curso: {fecha: Future}. Las requests concurrentes de una misma
+# fecha esperan el resultado (éxito o fallo) del único fetch en vuelo.
+_FX_INFLIGHT = {}
+
+# Cache del data warehouse, invalidado por fecha de modificación del archivo
+_DATA_CACHE = {"mtime": None, "index": None}
+
+def _build_cost_index(data):
+    """Aplana las recetas en arrays NumPy para calcular costos vectorizados."""
+    prices = data.get('prices', {})
+    recipes = data.get('recipes', [])
+
+    id_pos = {}
+    ing_names, qty_g, price_idx, offsets = [], [], [], []
+    for r in recipes:
+        offsets.append(len(qty_g))
+        for ing in r['ingredients']:
+            ing_names.append(ing['name'])
+            qty_g.append(ing['qty_g'])
+            price_idx.append(id_pos.setdefault(ing['id'], len(id_pos)))
+    offsets.append(len(qty_g))
+
+    # Precio 0 o ausente cuenta como faltante (NaN)
+    prices_vec = np.array([prices.get(key) or np.nan for key in id_pos], dtype=float)
+    offsets = np.array(offsets, dtype=np.intp)
+
+    return {
+        "recipe_names": [r['name'] for r in recipes],
+        "ing_names": ing_names,
+        "qty_g": np.array(qty_g, dtype=float),
+        "price_idx": np.array(price_idx, dtype=np.intp),
+        "prices_vec": prices_vec,
+        "offsets": offsets,
+        "recipe_idx": np.repeat(np.arange(len(recipes)), np.diff(offsets)),
+    }
+
+def _refresh_data_cache():
+    mtime = os.stat(DATA_FILE).st_mtime if os.path.exists(DATA_FILE) else None
+    if _DATA_CACHE["index"] is not None and mtime == _DATA_CACHE["mtime"]:
+        return
+
+    if mtime is None:
+        data = {"prices": {}, "recipes": []}
+    else:
+        with open(DATA_FILE, 'rb') as f:
+            data = orjson.loads(f.read())
+    index = _build_cost_index(data)
+    index["mtime"] = mtime
+    _DATA_CACHE.update(mtime=mtime, index=index)
+
+def load_cost_index():
+    _refresh_data_cache()
+    return _DATA_CACHE["index"]
+
+def _fetch_usd_rate(date_str):
    
     try:
         url = CURRENCY_API_URL.format(date=date_str)
         print(f"Consultando cotización: {url}")
-        response = requests.get(url, timeout=5)
+        response = _SESSION.get(url, timeout=CURRENCY_API_TIMEOUT)
         
         if response.status_code == 200:
             data = response.json()
@@ -35,6 +140,53 @@ def get_usd_rate(date_str):
         print(f"Excepción API Divisas: {e}")
         return None
 
+def _cached_usd_rate(date_str):
+    """Devuelve la cotización cacheada si sigue vigente, o None."""
+    cached = _FX_CACHE.get(date_str)
+    if cached:
+        rate, fetched_at = cached
+        is_past = date_str < datetime.now().strftime('%Y-%m-%d')
+        if is_past or time.time() - fetched_at < FX_TODAY_TTL:
+            return rate
+    return None
+
+def get_usd_rate(date_str):
+    rate = _cached_usd_rate(date_str)
+    if rate is not None:
+        return rate
+
+    # Un único fetch por fecha aunque lleguen varias requests concurrentes
+    with _FX_LOCK:
+        rate = _cached_usd_rate(date_str)
+        if rate is not None:
+            return rate
+        future = _FX_INFLIGHT.get(date_str)
+        is_owner = future is None
+        if is_owner:
+            future = _FX_INFLIGHT[date_str] = Future()
+
+    if not is_owner:
+        return future.result()
+
+    rate = None
+    try:
+        rate = _fetch_usd_rate(date_str)
+        if rate is None:
+            cached = _FX_CACHE.get(date_str)
+            if cached:
+                # Fallback: devolver el último valor conocido (stale)
+                print(f"Usando cotización cacheada (stale) para {date_str}")
+                rate = cached[0]
+        else:
+            with _FX_LOCK:
+                _FX_CACHE[date_str] = [rate, time.time()]
+                _save_fx_cache()
+        return rate
+    finally:
+        with _FX_LOCK:
+            _FX_INFLIGHT.pop(date_str, None)
+        future.set_result(rate)
+
 @app.route('/')
 def index():
     return send_file('index.html')
@@ -45,61 +197,86 @@ def calculate():
     target_date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
     
 
+    match = _DATE_RE.fullmatch(target_date)
+    if not match:
+        return jsonify({"error": "Formato de fecha inválido. Use YYYY-MM-DD"}), 400
     try:
-        datetime.strptime(target_date, '%Y-%m-%d')
+        date(int(match[1]), int(match[2]), int(match[3]))
     except ValueError:
         return jsonify({"error": "Formato de fecha inválido. Use YYYY-MM-DD"}), 400
 
     # Obtener cotización
     usd_rate = get_usd_rate(target_date)
     
-    data = load_data()
-    prices = data.get('prices', {})
-    recipes = data.get('recipes', [])
-    
+    # Detalle por ingrediente sólo a pedido (?details=1)
+    with_details = request.args.get('details', '0') == '1'
+
+    index = load_cost_index()
+
+    # La respuesta depende sólo de (fecha, versión del warehouse, cotización, detalle)
+    etag = hashlib.blake2b(
+        f"{target_date}|{index['mtime']}|{usd_rate}|{with_details}".encode(),
+        digest_size=8
+    ).hexdigest()
+    # Sin cotización la respuesta es parcial: no cachear, revalidar siempre
+    cache_control = 'private, max-age=300' if usd_rate is not None else 'no-cache'
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    n_recipes = len(index["recipe_names"])
+
+    # Costo por ingrediente (NaN si falta el precio) y suma por receta
+    costs = index["qty_g"] * index["prices_vec"][index["price_idx"]] / 1000.0
+    found = ~np.isnan(costs)
+    costs = np.nan_to_num(costs)
+    totals_ars = np.bincount(index["recipe_idx"], weights=costs, minlength=n_recipes)
+    missing = np.bincount(index["recipe_idx"], weights=~found, minlength=n_recipes) > 0
+
+    # Calcular costo en USD: los totales en ARS no dependen de la cotización
+    totals_usd = np.divide(totals_ars, usd_rate).tolist() if usd_rate else None
+
+    if with_details:
+        qty_list = index["qty_g"].tolist()
+        cost_list = costs.tolist()
+        found_list = found.tolist()
+    offsets = index["offsets"].tolist()
+
     results = []
     
-    for r in recipes:
-        total_ars = 0
-        missing = False
-        details = []
-        
-        for ing in r['ingredients']:
-            key = ing['id']
-            price_ars_kg = prices.get(key)
-            cost_ars = 0
-            
-            if price_ars_kg:
-             
-                cost_ars = (ing['qty_g'] / 1000) * price_ars_kg
-                total_ars += cost_ars
-            else:
-                missing = True
-                
-            details.append({
-                "name": ing['name'],
-                "qty_g": ing['qty_g'],
-                "cost_ars": cost_ars,
-                "found": bool(price_ars_kg)
-            })
-            
-        # Calcular costo en USD
-        total_usd = total_ars / usd_rate if usd_rate else None
-            
-        results.append({
-            "name": r['name'],
-            "total_cost_ars": total_ars,
-            "total_cost_usd": total_usd,
-            "has_missing": missing,
-            "ingredients": details
-        })
+    for i, name in enumerate(index["recipe_names"]):
+        result = {
+            "name": name,
+            "total_cost_ars": float(totals_ars[i]),
+            "total_cost_usd": totals_usd[i] if totals_usd else None,
+            "has_missing": bool(missing[i])
+        }
+
+        if with_details:
+            start, end = offsets[i], offsets[i + 1]
+            result["ingredients"] = [
+                {"name": n, "qty_g": q, "cost_ars": c, "found": f}
+                for n, q, c, f in zip(
+                    index["ing_names"][start:end], qty_list[start:end],
+                    cost_list[start:end], found_list[start:end]
+                )
+            ]
+
+        results.append(result)
     
-    return jsonify({
+    payload = {
         "date": target_date,
         "usd_rate": usd_rate,
         "recipes": results
-    })
+    }
+    response = app.response_class(orjson.dumps(payload), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
 
 if __name__ == '__main__':
+    # Sólo para desarrollo; en producción: gunicorn (ver Dockerfile)
     print("Servidor corriendo...")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    app.run(host='0.0.0.0', port=5000, debug=False)
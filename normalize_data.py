@@ -1,14 +1,20 @@
-import json
+import functools
 import re
 import os
 import logging
+import unicodedata
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any, Tuple
-from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Any, Tuple, TypedDict
 
-# Librerías externas (pip install pandas openpyxl pdfplumber)
+# Librerías externas (pip install pandas openpyxl pdfplumber pymupdf pyahocorasick orjson rapidfuzz)
+import ahocorasick
+import orjson
 import pandas as pd
 import pdfplumber
+import pymupdf
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein
 
 logging.basicConfig(
     level=logging.INFO,
@@ -21,52 +27,75 @@ logger = logging.getLogger("ETL_Pipeline")
 INPUT_DIR = 'inputs'
 OUTPUT_FILE = 'data_warehouse.json'
 
+# Patrones precompilados
+_PRICE_RE = re.compile(r'([\d\.,]+)')
+_H1_SPLIT_RE = re.compile(r'^#\s+', re.MULTILINE)
+# Patrón A: "1 kg de Tomate" / "250 grs de ..."
+_PAT_A = re.compile(r'([\d\.,]+)\s*(kg|g|kgs|grs)\s*(?:de)?\s*(.+)', re.IGNORECASE)
+# Patrón B: "Tomate: 500 g" (Formato inverso)
+_PAT_B = re.compile(r'(.+):\s*([\d\.,]+)\s*(kg|g|kgs|grs)', re.IGNORECASE)
+_WORD_RE = re.compile(r'\w+')
 
-@dataclass
-class IngredientItem:
+
+class IngredientItem(TypedDict):
     """Representa un ingrediente dentro de una receta."""
     id: str  
     name: str 
     qty_g: float
 
-@dataclass
-class Recipe:
+class Recipe(TypedDict):
     """Representa una receta completa."""
     name: str
-    ingredients: List[IngredientItem] = field(default_factory=list)
-
-    def to_dict(self) -> Dict[str, Any]:
-        return {
-            "name": self.name,
-            "ingredients": [
-                {"id": i.id, "name": i.name, "qty_g": i.qty_g} 
-                for i in self.ingredients
-            ]
-        }
+    ingredients: List[IngredientItem]
 
 # --- nORMALIZACIÓN ---
 
+def _strip_diacritics(text: str) -> str:
+    """Minúsculas, sin tildes ni diéresis (NFKD) y sin espacios en los extremos."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).strip()
+
+def _build_automaton(mapping: Dict[str, str]) -> ahocorasick.Automaton:
+    """Construye un autómata Aho-Corasick con todas las claves del mapa."""
+    automaton = ahocorasick.Automaton()
+    for key, val in mapping.items():
+        automaton.add_word(key, (len(key), val))
+    automaton.make_automaton()
+    return automaton
+
+_TRIE_END = '$'  # Marca de nodo terminal (nunca es un token de _WORD_RE)
+
+def _build_word_trie(mapping: Dict[str, str]) -> Dict[str, Any]:
+    """Construye un trie por palabras: cada clave es un camino de tokens."""
+    trie: Dict[str, Any] = {}
+    for key, val in mapping.items():
+        node = trie
+        for token in _WORD_RE.findall(key):
+            node = node.setdefault(token, {})
+        node[_TRIE_END] = val
+    return trie
+
 class NormalizationService:
     
     
-    # Source of Truth
+    # Source of Truth (las claves se comparan sin tildes, ver _NORM_MAP)
     _MASTER_MAP = {
         # Verduras
         "tomate": "tomate", "lechuga": "lechuga", "zanahoria": "zanahoria", 
-        "papa": "papa", "cebolla": "cebolla", "morron": "morron", "morrón": "morron", 
+        "papa": "papa", "cebolla": "cebolla", "morron": "morron", 
         "zapallo": "zapallo", "acelga": "acelga", "espinaca": "espinaca", 
-        "brócoli": "brocoli", "brocoli": "brocoli", "coli": "brocoli",
+        "brocoli": "brocoli", "coli": "brocoli",
         "berenjena": "berenjena", "calabaza": "calabaza", "pepino": "pepino", 
         "remolacha": "remolacha", "batata": "batata", "choclo": "choclo",
         
         # Carnes & Pescados
         "asado de tira": "asado_de_tira", "asado": "asado_de_tira",
-        "vacio": "vacio", "vacío": "vacio",
+        "vacio": "vacio",
         "bife de chorizo": "bife_de_chorizo", "lomo": "lomo", "cuadril": "cuadril", 
         "roast beef": "roast_beef", "falda": "falda", "matambre": "matambre", 
         "entraña": "entrana", "carne picada": "carne_picada", "carne picada especial": "carne_picada",
         "bondiola": "bondiola", "costillas": "costillas", "lomo de cerdo": "lomo_cerdo", 
-        "jamón fresco": "jamon", "jamon fresco": "jamon", "panceta": "panceta",
+        "jamon fresco": "jamon", "panceta": "panceta",
         "pollo entero": "pollo", "pollo": "pollo", "pechuga": "pechuga", 
         "muslo": "muslo", "ala": "ala", "patamuslo": "patamuslo", "supremas": "supremas",
         "merluza fresca": "merluza", "merluza": "merluza",
@@ -76,21 +105,87 @@ class NormalizationService:
         "calamar limpio": "calamar", "calamar": "calamar", "mejillones": "mejillones"
     }
 
+    # Claves precalculadas sin tildes: "morrón" y "morron" son la misma entrada
+    _NORM_MAP = {_strip_diacritics(k): v for k, v in _MASTER_MAP.items()}
+
+    _MASTER_KEYS = list(_NORM_MAP)
+    # Distancia de edición máxima para aceptar una coincidencia aproximada
+    _FUZZY_MAX_DISTANCE = 1
+
+    _AUTOMATON = _build_automaton(_NORM_MAP)
+    _WORD_TRIE = _build_word_trie(_NORM_MAP)
+
+    @classmethod
+    def _longest_word_match(cls, clean_text: str) -> Tuple[int, Optional[str]]:
+        """Recorre el texto por palabras y devuelve (largo en caracteres, valor) del tramo más largo del trie."""
+        tokens = list(_WORD_RE.finditer(clean_text))
+        best_len, best_val = 0, None
+        i = 0
+        while i < len(tokens):
+            node = cls._WORD_TRIE
+            span, val = 0, None
+            for j in range(i, len(tokens)):
+                node = node.get(tokens[j].group())
+                if node is None:
+                    break
+                if _TRIE_END in node:
+                    span, val = j - i + 1, node[_TRIE_END]
+            if span:
+                match_len = tokens[i + span - 1].end() - tokens[i].start()
+                if match_len > best_len:
+                    best_len, best_val = match_len, val
+            # Avanzar más allá del tramo encontrado
+            i += span or 1
+        return best_len, best_val
+
     @classmethod
+    @functools.lru_cache(maxsize=65536)
     def normalize(cls, text: str) -> Optional[str]:
-        """Limpia el texto y busca una coincidencia en el mapa maestro."""
+        """Limpia el texto y busca una coincidencia en el mapa maestro.
+
+        Memoizado: el mapa es inmutable en runtime y los mismos textos
+        (encabezados, productos repetidos) se normalizan muchas veces.
+
+        >>> NormalizationService.normalize("Lomo de cerdos")
+        'lomo_cerdo'
+        >>> NormalizationService.normalize("bife de chorizo y lomo")
+        'bife_de_chorizo'
+        >>> NormalizationService.normalize("tomatte")
+        'tomate'
+        >>> NormalizationService.normalize("zapallito") is None
+        True
+        """
         if not isinstance(text, str): return None
         
-        clean_text = text.lower().strip()
+        clean_text = _strip_diacritics(text)
         
         # 1. Búsqueda exacta O(1)
-        if clean_text in cls._MASTER_MAP:
-            return cls._MASTER_MAP[clean_text]
+        if clean_text in cls._NORM_MAP:
+            return cls._NORM_MAP[clean_text]
             
-        # 2. Búsqueda parcial (contiene) - O(N) pero robusto para variaciones
-        for key, val in cls._MASTER_MAP.items():
-            if key in clean_text:
-                return val
+        # 2. Búsqueda por palabras en el trie - gana el tramo más largo
+        # ("bife de chorizo" no se confunde con "lomo", "lomo de cerdo" con "lomo")
+        word_len, word_val = cls._longest_word_match(clean_text)
+
+        # 3. Búsqueda parcial (contiene) - una sola pasada del autómata.
+        # Sólo reemplaza al trie si encuentra una clave más larga
+        # ("lomo de cerdos": el trie ve "lomo", el autómata "lomo de cerdo")
+        best_len, best_val = word_len, word_val
+        for _, (key_len, val) in cls._AUTOMATON.iter(clean_text):
+            if key_len > best_len:
+                best_len, best_val = key_len, val
+        if best_val:
+            return best_val
+
+        # 4. Búsqueda aproximada (typos) - sólo si todo lo anterior falló.
+        # Tope explícito de distancia de edición: un typo sí, un diminutivo
+        # no ("zapallito" no debe volverse "zapallo", ni "bondiolita" "bondiola").
+        fuzzy = process.extractOne(
+            clean_text, cls._MASTER_KEYS,
+            scorer=Levenshtein.distance, score_cutoff=cls._FUZZY_MAX_DISTANCE
+        )
+        if fuzzy:
+            return cls._NORM_MAP[fuzzy[0]]
         return None
 
 
@@ -115,7 +210,23 @@ class PriceExtractor(BaseExtractor):
         pass
 
 class PDFPriceExtractor(PriceExtractor):
-    """Extrae precios de PDFs usando análisis de layout (pdfplumber)."""
+    """Extrae precios de PDFs (texto nativo con PyMuPDF, pdfplumber como fallback)."""
+
+    def _page_texts(self) -> Iterator[str]:
+        """Devuelve el texto de cada página, de a una por vez."""
+        has_text = False
+        with pymupdf.open(self.filepath) as doc:
+            for page in doc:
+                # sort=True: orden de lectura, deja nombre y precio en la misma línea
+                text = page.get_text(sort=True)
+                has_text = has_text or bool(text.strip())
+                yield text
+
+        if not has_text:
+            logger.info(f"PyMuPDF no devolvió texto, usando pdfplumber: {self.filepath}")
+            with pdfplumber.open(self.filepath) as pdf:
+                for page in pdf.pages:
+                    yield page.extract_text() or ""
     
     def extract(self) -> Dict[str, float]:
         prices = {}
@@ -123,16 +234,16 @@ class PDFPriceExtractor(PriceExtractor):
 
         logger.info(f"Extrayendo precios de PDF: {self.filepath}")
         try:
-            with pdfplumber.open(self.filepath) as pdf:
-                full_text = "".join([p.extract_text() or "" for p in pdf.pages])
+            # Procesar página por página: sólo el texto de una página en memoria
+            for text in self._page_texts():
                 
-                for line in full_text.split('\n'):
+                for line in text.splitlines():
                   
                     if '$' in line:
-                        parts = line.split('$')
-                        name_part = parts[0].strip()
+                        name_part, _, price_part = line.partition('$')
+                        name_part = name_part.strip()
                         
-                        price_part_match = re.search(r'([\d\.,]+)', parts[1])
+                        price_part_match = _PRICE_RE.search(price_part)
                         
                         if price_part_match:
                             price_str = price_part_match.group(1)
@@ -171,20 +282,33 @@ class ExcelPriceExtractor(PriceExtractor):
             else:
                 df = pd.read_excel(self.filepath, header=None)
             
-            # Barrido: Buscar patrón (Texto) -> (Precio) en celdas adyacentes
-            for r in range(df.shape[0]):
-                for c in range(df.shape[1] - 1):
-                    val_name = str(df.iat[r, c])
-                    val_price = str(df.iat[r, c+1])
-                    
-                    norm_key = NormalizationService.normalize(val_name)
-                    
-                    # Validar si val_price parece dinero
-                    if norm_key and ('$' in val_price or val_price.replace('.','').isdigit()):
-                        try:
-                            clean_p = val_price.replace('$', '').replace('.', '').replace(',', '.').strip()
-                            prices[norm_key] = float(clean_p)
-                        except ValueError: pass
+            # Barrido: Buscar patrón (Texto) -> (Precio) en celdas adyacentes.
+            # Cada celda (r, c) se empareja con (r, c+1) aplanando la grilla.
+            grid = df.astype(str).to_numpy()
+            names = grid[:, :-1].ravel()
+            price_cells = pd.Series(grid[:, 1:].ravel())
+            
+            # Validar si val_price parece dinero (máscara sobre toda la grilla)
+            price_mask = (
+                price_cells.str.contains('$', regex=False)
+                | price_cells.str.replace('.', '', regex=False).str.isdigit()
+            ).to_numpy()
+            
+            # Descartar celdas que no pueden ser nombres (números, vacías, NaN)
+            name_mask = df.map(
+                lambda v: isinstance(v, str) and len(v.strip()) >= 3
+                and not v.replace('.', '').replace(',', '').isdigit()
+            ).to_numpy(dtype=bool)[:, :-1].ravel()
+            pair_mask = price_mask & name_mask
+            
+            for val_name, val_price in zip(names[pair_mask], price_cells[pair_mask]):
+                norm_key = NormalizationService.normalize(val_name)
+                
+                if norm_key:
+                    try:
+                        clean_p = val_price.replace('$', '').replace('.', '').replace(',', '.').strip()
+                        prices[norm_key] = float(clean_p)
+                    except ValueError: pass
                         
         except Exception as e:
             logger.error(f"Fallo al procesar Excel: {e}")
@@ -204,7 +328,7 @@ class RecipeExtractor(BaseExtractor):
                 content = f.read()
             
             # Dividir por bloques H1 (# Titulo)
-            blocks = re.split(r'^#\s+', content, flags=re.MULTILINE)
+            blocks = _H1_SPLIT_RE.split(content)
             
             for block in blocks:
                 lines = [l.strip() for l in block.split('\n') if l.strip()]
@@ -220,7 +344,7 @@ class RecipeExtractor(BaseExtractor):
                         ingredients.append(parsed_ing)
                 
                 if ingredients:
-                    recipes.append(Recipe(name=title, ingredients=ingredients))
+                    recipes.append({"name": title, "ingredients": ingredients})
                     
         except Exception as e:
             logger.error(f"Fallo al procesar MD: {e}")
@@ -230,11 +354,11 @@ class RecipeExtractor(BaseExtractor):
     def _parse_ingredient_line(self, line: str) -> Optional[IngredientItem]:
         """Parsea una línea de texto a un objeto ingrediente usando Regex."""
         # Patrón A: "1 kg de Tomate" / "250 grs de ..."
-        match = re.search(r'([\d\.,]+)\s*(kg|g|kgs|grs)\s*(?:de)?\s*(.+)', line, re.IGNORECASE)
+        match = _PAT_A.search(line)
         
         # Patrón B: "Tomate: 500 g" (Formato inverso)
         if not match:
-            match = re.search(r'(.+):\s*([\d\.,]+)\s*(kg|g|kgs|grs)', line, re.IGNORECASE)
+            match = _PAT_B.search(line)
             if match:
                 prod, cant, unit = match.groups()
             else:
@@ -252,7 +376,7 @@ class RecipeExtractor(BaseExtractor):
             if unit.lower().startswith('kg'):
                 qty *= 1000
             
-            return IngredientItem(id=norm_key, name=prod.strip(), qty_g=qty)
+            return {"id": norm_key, "name": prod.strip(), "qty_g": qty}
         except ValueError:
             return None
 
@@ -266,18 +390,24 @@ class DataPipeline:
     def run(self):
         logger.info(">>> INICIANDO PIPELINE ETL <<<")
         
-        # 1. Ingesta de Precios
+        # Los extractores son independientes: se ejecutan en paralelo
         pdf_ex = PDFPriceExtractor("verduleria.pdf")
         xls_ex = ExcelPriceExtractor("Carnes y Pescados.xlsx")
-        
-        self.prices_data.update(pdf_ex.extract())
-        self.prices_data.update(xls_ex.extract())
-        
-        logger.info(f"Precios consolidados: {len(self.prices_data)} ítems.")
-
-        # 2. Ingesta de Recetas
         md_ex = RecipeExtractor("Recetas.md")
-        self.recipes_data = md_ex.extract()
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            f_pdf = executor.submit(pdf_ex.extract)
+            f_xls = executor.submit(xls_ex.extract)
+            f_md = executor.submit(md_ex.extract)
+
+            # 1. Ingesta de Precios (el Excel pisa al PDF, como antes)
+            self.prices_data.update(f_pdf.result())
+            self.prices_data.update(f_xls.result())
+            
+            logger.info(f"Precios consolidados: {len(self.prices_data)} ítems.")
+
+            # 2. Ingesta de Recetas
+            self.recipes_data = f_md.result()
         
         logger.info(f"Recetas procesadas: {len(self.recipes_data)} recetas.")
 
@@ -286,15 +416,19 @@ class DataPipeline:
         logger.info(">>> PIPELINE FINALIZADO CON ÉXITO <<<")
 
     def _save(self):
-        output = {
-            "metadata": {"version": "2.0", "generated_by": "Python ETL"},
-            "prices": self.prices_data,
-            "recipes": [r.to_dict() for r in self.recipes_data]
-        }
+        metadata = {"version": "2.0", "generated_by": "Python ETL"}
         
         try:
-            with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
-                json.dump(output, f, indent=4, ensure_ascii=False)
+            # Escritura incremental: encabezado + una receta por línea, sin
+            # armar el documento completo en memoria
+            with open(OUTPUT_FILE, 'wb') as f:
+                f.write(b'{\n  "metadata": ' + orjson.dumps(metadata))
+                f.write(b',\n  "prices": ' + orjson.dumps(self.prices_data, option=orjson.OPT_NON_STR_KEYS))
+                f.write(b',\n  "recipes": [')
+                for i, recipe in enumerate(self.recipes_data):
+                    f.write(b',\n    ' if i else b'\n    ')
+                    f.write(orjson.dumps(recipe))
+                f.write(b'\n  ]\n}\n')
             logger.info(f"Data Warehouse guardado en: {os.path.abspath(OUTPUT_FILE)}")
         except IOError as e:
             logger.error(f"Error guardando archivo final: {e}")